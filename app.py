@@ -1,191 +1,322 @@
-"""
-FastAPI backend for Negotiation Chatbot.
-Handles login, chat sessions, and LangGraph workflow execution.
-"""
-import uuid
-from typing import Any, Dict, Optional
-
-from fastapi import FastAPI, HTTPException
-from logger_config import get_logger
-
-logger = get_logger("api")
-from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-
-from backend import NegotiationState, workflow_maker
-from db import fetch_builder_by_email_and_password
-
-# Compile workflow once (uses NegotiationState)
-graph_app = workflow_maker(NegotiationState)
-
-# In-memory session store: session_token -> {thread_id, builder_info}
-sessions: Dict[str, Dict[str, Any]] = {}
-
-app = FastAPI(title="Negotiation Chatbot API")
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["http://localhost:3000", "http://localhost:3001", "http://127.0.0.1:3000", "http://127.0.0.1:3001"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-
-# --- Request/Response models ---
-class LoginRequest(BaseModel):
-    email: str
-    password: str
-
-
-class LoginResponse(BaseModel):
-    success: bool
-    session_token: Optional[str] = None
-    builder_name: Optional[str] = None
-    error: Optional[str] = None
-
-
-class ChatMessageRequest(BaseModel):
-    message: str
-    session_token: str
-
-
-class ChatResponse(BaseModel):
-    chat: list
-    conversation_ended: bool
-    error: Optional[str] = None
-
-
-class StartChatRequest(BaseModel):
-    session_token: str
-
-
-# --- API routes ---
-@app.post("/api/login", response_model=LoginResponse)
-def login(req: LoginRequest):
-    """Authenticate user and create session with builder_info."""
-    logger.info("Login attempt: email=%s", req.email)
-    builder = fetch_builder_by_email_and_password(req.email, req.password)
-    if not builder:
-        logger.warning("Login failed: invalid credentials for %s", req.email)
-        return LoginResponse(success=False, error="Invalid email or password")
-
-    session_token = str(uuid.uuid4())
-    builder_info_dict = {
-        "builder_id": builder.builder_id,
-        "builder_name": builder.builder_name,
-        "city": builder.city,
-        "payment_history": builder.payment_history,
-        "total_orders": builder.total_orders,
-        "total_value": builder.total_value,
-    }
-    sessions[session_token] = {
-        "thread_id": None,  # set on first chat start
-        "builder_info": builder_info_dict,
-    }
-    logger.info("Login success: builder=%s, session_token=%s", builder.builder_name, session_token[:8])
-    return LoginResponse(
-        success=True,
-        session_token=session_token,
-        builder_name=builder.builder_name,
-    )
-
-
-def _get_session(session_token: str) -> Dict[str, Any]:
-    if session_token not in sessions:
-        logger.warning("Invalid session token: %s", session_token[:8] if session_token else "None")
-        raise HTTPException(status_code=401, detail="Invalid or expired session")
-    return sessions[session_token]
-
-
-@app.post("/api/chat/start")
-def start_chat(req: StartChatRequest):
-    """Start a new chat. Creates thread and initializes graph with builder_info."""
-    logger.info("Start chat request")
-    sess = _get_session(req.session_token)
-    thread_id = str(uuid.uuid4())
-    sess["thread_id"] = thread_id
-
-    # Initial state with builder_info (from login)
-    initial_state = NegotiationState(
-        builder_info=sess["builder_info"],
-        chat_history_reply=[],
-    ).model_dump()
-
-    config = {"configurable": {"thread_id": thread_id}}
-
-    # Invoke - will interrupt before User_input_1
-    logger.debug("Invoking graph for thread_id=%s", thread_id)
-    graph_app.invoke(initial_state, config=config)
-
-    # Get state from checkpoint (invoke may return wrapped format)
-    state_snapshot = graph_app.get_state(config)
-    values = getattr(state_snapshot, "values", state_snapshot) if state_snapshot else {}
-    chat = values.get("chat_history_reply", []) if isinstance(values, dict) else []
-    ended = values.get("conversation_ended", False) if isinstance(values, dict) else False
-
-    logger.info("Chat started: thread_id=%s", thread_id)
-    return {"chat": chat, "conversation_ended": ended}
-
-
-@app.post("/api/chat", response_model=ChatResponse)
-def send_message(req: ChatMessageRequest):
-    """Send user message and run graph. Returns updated chat and conversation_ended flag."""
-    sess = _get_session(req.session_token)
-    logger.info("Chat message: msg_len=%d, first_message=%s", len(req.message), not sess.get("thread_id"))
-    thread_id = sess.get("thread_id")
-    builder_info = sess["builder_info"]
-
-    # First message: no thread yet, create thread and run full flow
-    if not thread_id:
-        thread_id = str(uuid.uuid4())
-        sess["thread_id"] = thread_id
-        initial_state = NegotiationState(
-            builder_info=builder_info,
-            chat_history_reply=[],
-            last_user_message=req.message,
-        ).model_dump()
-        config = {"configurable": {"thread_id": thread_id}}
-        try:
-            graph_app.invoke(initial_state, config=config)  # Interrupts before User_input_1
-            graph_app.invoke(None, config=config)  # Continue: run User_input_1 and rest of graph
-        except Exception as e:
-            logger.exception("Graph invoke error (first message): %s", e)
-            return ChatResponse(chat=[], conversation_ended=False, error=str(e))
-    else:
-        config = {"configurable": {"thread_id": thread_id}}
-        try:
-            # With interrupt_before, resume requires: 1) update state with user message, 2) invoke(None) to continue
-            state_snapshot = graph_app.get_state(config)
-            values = getattr(state_snapshot, "values", {}) or {}
-            current_chat = list(values.get("chat_history_reply") or [])
-            current_chat.append({"role": "user", "content": req.message})
-            graph_app.update_state(config, {"chat_history_reply": current_chat})
-            graph_app.invoke(None, config=config)
-        except Exception as e:
-            logger.exception("Graph invoke error: %s", e)
-            return ChatResponse(chat=[], conversation_ended=False, error=str(e))
-
-    # Get state from checkpoint (reliable source after invoke)
-    state_snapshot = graph_app.get_state(config)
-    values = getattr(state_snapshot, "values", state_snapshot) if state_snapshot else {}
-    chat = values.get("chat_history_reply", []) if isinstance(values, dict) else []
-    ended = values.get("conversation_ended", False) if isinstance(values, dict) else False
-
-    logger.info("Chat response: messages=%d, conversation_ended=%s", len(chat), ended)
-    return ChatResponse(chat=chat, conversation_ended=ended)
-
-
-@app.post("/api/chat/start-new")
-def start_new_chat(req: StartChatRequest):
-    """Reset conversation: new thread_id, clear checkpoint."""
-    sess = _get_session(req.session_token)
-    sess["thread_id"] = None
-    logger.info("Start new chat: session reset")
-    return {"chat": [], "conversation_ended": False}
-
-
-if __name__ == "__main__":
-    import uvicorn
-    logger.info("Starting API server on 0.0.0.0:8000")
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+"""
+FastAPI backend for Negotiation Chatbot.
+Handles login, chat sessions, and LangGraph workflow execution.
+"""
+import asyncio
+import json
+import os
+import secrets
+import threading
+import uuid
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional
+
+import orjson
+import redis.asyncio as aioredis
+from cachetools import TTLCache
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
+from logger_config import get_logger
+
+logger = get_logger("api")
+from fastapi.middleware.cors import CORSMiddleware
+from pydantic import BaseModel
+
+from backend import NegotiationState, workflow_maker
+from db import fetch_builder_by_email_and_password
+
+REDIS_URL = os.getenv("REDIS_URL")
+
+# Session TTL: refreshed on every write so active sessions stay alive
+SESSION_TTL_SECONDS = 3600
+
+
+class _LocalSessionStore:
+    """In-process fallback session store when Redis is unavailable.
+
+    Mirrors the redis.asyncio get/set interface used here. TTLCache bounds
+    both entry count and age, and the lock guards the compound operations
+    Starlette may run from multiple threadpool threads.
+    """
+
+    def __init__(self) -> None:
+        self._cache: TTLCache = TTLCache(maxsize=10_000, ttl=SESSION_TTL_SECONDS)
+        self._lock = threading.Lock()
+
+    async def set(self, key: str, value: str, ex: Optional[int] = None) -> None:
+        with self._lock:
+            self._cache[key] = value
+
+    async def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            return self._cache.get(key)
+
+    async def aclose(self) -> None:
+        pass
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Compile the workflow once per process (workflow_maker is lru_cached)
+    app.state.graph_app = workflow_maker(NegotiationState)
+    # Async checkpointers (Redis/SQLite) defer their schema setup until an
+    # event loop is running; run it here before the first request.
+    saver = app.state.graph_app.checkpointer
+    setup = getattr(saver, "asetup", None) or getattr(saver, "setup", None)
+    if setup is not None and asyncio.iscoroutinefunction(setup):
+        await setup()
+    if REDIS_URL:
+        app.state.redis = aioredis.from_url(REDIS_URL, decode_responses=True)
+    else:
+        logger.warning("REDIS_URL not set; using in-process session store")
+        app.state.redis = _LocalSessionStore()
+    yield
+    await app.state.redis.aclose()
+
+
+app = FastAPI(
+    title="Negotiation Chatbot API",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
+
+# Registered last so CORS runs outermost and preflight OPTIONS short-circuits
+# before any other middleware added later.
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["http://localhost:3000", "http://localhost:3001", "http://127.0.0.1:3000", "http://127.0.0.1:3001"],
+    allow_credentials=True,
+    allow_methods=["GET", "POST", "OPTIONS"],
+    allow_headers=["Content-Type", "Authorization"],
+)
+
+
+# --- Request/Response models ---
+class LoginRequest(BaseModel):
+    email: str
+    password: str
+
+
+class LoginResponse(BaseModel):
+    success: bool
+    session_token: Optional[str] = None
+    builder_name: Optional[str] = None
+    error: Optional[str] = None
+
+
+# Serialized once; failed logins are the hot path under credential stuffing
+_INVALID_CREDS_RESPONSE = LoginResponse(
+    success=False, error="Invalid email or password"
+).model_dump()
+
+
+class ChatMessageRequest(BaseModel):
+    message: str
+    session_token: str
+
+
+class ChatResponse(BaseModel):
+    chat: list
+    conversation_ended: bool
+    error: Optional[str] = None
+
+
+class StartChatRequest(BaseModel):
+    session_token: str
+
+
+# --- API routes ---
+@app.post("/api/login", response_model=LoginResponse)
+async def login(req: LoginRequest, request: Request):
+    """Authenticate user and create session with builder_info."""
+    logger.info("Login attempt: email=%s", req.email)
+    builder = await asyncio.to_thread(fetch_builder_by_email_and_password, req.email, req.password)
+    if not builder:
+        logger.warning("Login failed: invalid credentials for %s", req.email)
+        return JSONResponse(_INVALID_CREDS_RESPONSE)
+
+    session_token = secrets.token_urlsafe(16)
+    builder_info_dict = {
+        "builder_id": builder.builder_id,
+        "builder_name": builder.builder_name,
+        "city": builder.city,
+        "payment_history": builder.payment_history,
+        "total_orders": builder.total_orders,
+        "total_value": builder.total_value,
+    }
+    await _save_session(request, session_token, {
+        "thread_id": None,  # set on first chat start
+        "builder_info": builder_info_dict,
+    })
+    logger.info("Login success: builder=%s, session_token=%s", builder.builder_name, session_token[:8])
+    return LoginResponse(
+        success=True,
+        session_token=session_token,
+        builder_name=builder.builder_name,
+    )
+
+
+def _snapshot_payload(state_snapshot) -> tuple[list, bool]:
+    """Extract (chat_history_reply, conversation_ended) from a StateSnapshot."""
+    values = state_snapshot.values if state_snapshot else {}
+    return values.get("chat_history_reply", []), values.get("conversation_ended", False)
+
+
+async def _save_session(request: Request, session_token: str, sess: Dict[str, Any]) -> None:
+    """Persist session data under sess:<token>, refreshing its TTL."""
+    await request.app.state.redis.set(
+        f"sess:{session_token}", json.dumps(sess), ex=SESSION_TTL_SECONDS
+    )
+
+
+async def _get_session(request: Request, session_token: str) -> Dict[str, Any]:
+    raw = await request.app.state.redis.get(f"sess:{session_token}")
+    if raw is None:
+        logger.warning("Invalid session token: %s", session_token[:8] if session_token else "None")
+        raise HTTPException(status_code=401, detail="Invalid or expired session")
+    return json.loads(raw)
+
+
+@app.post("/api/chat/start")
+async def start_chat(req: StartChatRequest, request: Request):
+    """Start a new chat. Creates thread and initializes graph with builder_info."""
+    logger.info("Start chat request")
+    graph_app = request.app.state.graph_app
+    sess = await _get_session(request, req.session_token)
+    thread_id = uuid.uuid4().hex
+    sess["thread_id"] = thread_id
+    await _save_session(request, req.session_token, sess)
+
+    # Initial state with builder_info (from login)
+    initial_state = NegotiationState.initial_dict(sess["builder_info"])
+
+    config = {"configurable": {"thread_id": thread_id}}
+
+    # Invoke - will interrupt before User_input_1
+    logger.debug("Invoking graph for thread_id=%s", thread_id)
+    await graph_app.ainvoke(initial_state, config=config)
+
+    # Get state from checkpoint
+    state_snapshot = await graph_app.aget_state(config)
+    chat, ended = _snapshot_payload(state_snapshot)
+
+    logger.info("Chat started: thread_id=%s", thread_id)
+    return {"chat": chat, "conversation_ended": ended}
+
+
+@app.post("/api/chat", response_model=ChatResponse)
+async def send_message(req: ChatMessageRequest, request: Request):
+    """Send user message and run graph. Returns updated chat and conversation_ended flag."""
+    graph_app = request.app.state.graph_app
+    sess = await _get_session(request, req.session_token)
+    logger.info("Chat message: msg_len=%d, first_message=%s", len(req.message), not sess.get("thread_id"))
+    thread_id = sess.get("thread_id")
+    builder_info = sess["builder_info"]
+
+    # First message: no thread yet, create thread and run full flow
+    if not thread_id:
+        thread_id = uuid.uuid4().hex
+        sess["thread_id"] = thread_id
+        await _save_session(request, req.session_token, sess)
+        initial_state = NegotiationState.initial_dict(
+            builder_info, last_user_message=req.message
+        )
+        config = {"configurable": {"thread_id": thread_id}}
+        try:
+            await graph_app.ainvoke(initial_state, config=config)  # Interrupts before User_input_1
+            await graph_app.ainvoke(None, config=config)  # Continue: run User_input_1 and rest of graph
+        except Exception as e:
+            logger.exception("Graph invoke error (first message): %s", e)
+            return ChatResponse(chat=[], conversation_ended=False, error=str(e))
+    else:
+        config = {"configurable": {"thread_id": thread_id}}
+        try:
+            # Feed the user message through the last_user_message channel; the
+            # interrupted User_input_* node appends it to chat_history_reply on
+            # resume. Avoids the get_state + full-history rewrite round-trips.
+            await graph_app.aupdate_state(config, {"last_user_message": req.message})
+            await graph_app.ainvoke(None, config=config)
+        except Exception as e:
+            logger.exception("Graph invoke error: %s", e)
+            return ChatResponse(chat=[], conversation_ended=False, error=str(e))
+
+    # Get state from checkpoint (reliable source after invoke)
+    state_snapshot = await graph_app.aget_state(config)
+    chat, ended = _snapshot_payload(state_snapshot)
+
+    logger.info("Chat response: messages=%d, conversation_ended=%s", len(chat), ended)
+    return ChatResponse(chat=chat, conversation_ended=ended)
+
+
+@app.post("/api/chat/stream")
+async def send_message_stream(req: ChatMessageRequest, request: Request):
+    """Send user message and stream assistant tokens as Server-Sent Events.
+
+    Emits {"token": ...} events as the LLM generates, then a final
+    {"chat": ..., "conversation_ended": ...} event once the graph settles.
+    """
+    graph_app = request.app.state.graph_app
+    sess = await _get_session(request, req.session_token)
+    thread_id = sess.get("thread_id")
+    builder_info = sess["builder_info"]
+
+    if not thread_id:
+        thread_id = uuid.uuid4().hex
+        sess["thread_id"] = thread_id
+        await _save_session(request, req.session_token, sess)
+        config = {"configurable": {"thread_id": thread_id}}
+        initial_state = NegotiationState.initial_dict(
+            builder_info, last_user_message=req.message
+        )
+        await graph_app.ainvoke(initial_state, config=config)  # Interrupts before User_input_1
+    else:
+        config = {"configurable": {"thread_id": thread_id}}
+        await graph_app.aupdate_state(config, {"last_user_message": req.message})
+
+    async def event_generator():
+        try:
+            async for event in graph_app.astream_events(None, config=config, version="v2"):
+                if event.get("event") == "on_chat_model_stream":
+                    content = getattr(event["data"]["chunk"], "content", "")
+                    if content:
+                        yield f"data: {orjson.dumps({'token': content}).decode()}\n\n"
+        except Exception as e:
+            logger.exception("Graph stream error: %s", e)
+            yield f"data: {orjson.dumps({'error': str(e)}).decode()}\n\n"
+
+        # Final authoritative state from the checkpoint
+        state_snapshot = await graph_app.aget_state(config)
+        chat, ended = _snapshot_payload(state_snapshot)
+        yield f"data: {orjson.dumps({'chat': chat, 'conversation_ended': ended}).decode()}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(event_generator(), media_type="text/event-stream")
+
+
+@app.post("/api/chat/start-new", status_code=204, response_class=Response)
+async def start_new_chat(req: StartChatRequest, request: Request):
+    """Reset conversation: new thread_id, clear checkpoint. 204 = reset OK."""
+    sess = await _get_session(request, req.session_token)
+    sess["thread_id"] = None
+    await _save_session(request, req.session_token, sess)
+    logger.info("Start new chat: session reset")
+    return Response(status_code=204)
+
+
+if __name__ == "__main__":
+    import uvicorn
+    # Without Redis, sessions and checkpoints live in per-process stores, so
+    # multiple workers would round-robin requests away from their state.
+    # The 2n+1 topology only makes sense once REDIS_URL points at shared
+    # storage (see the README's gunicorn line for production).
+    workers = (2 * (os.cpu_count() or 1)) + 1 if REDIS_URL else 1
+    logger.info("Starting API server on 0.0.0.0:8000 with %d workers", workers)
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=workers,
+        loop="uvloop",
+        http="httptools",
+        timeout_keep_alive=75,
+    )
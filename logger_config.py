@@ -1,28 +1,52 @@
-"""
-Logger configuration for Negotiation Chatbot.
-Writes logs to negotiation_chatbot.log in the project directory.
-"""
-import logging
-import os
-
-LOG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "negotiation_chatbot.txt")
-
-# Create formatter
-_formatter = logging.Formatter(
-    "%(asctime)s | %(levelname)-8s | %(name)s | %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-)
-
-# File handler - append to txt log file
-_file_handler = logging.FileHandler(LOG_FILE, encoding="utf-8")
-_file_handler.setLevel(logging.DEBUG)
-_file_handler.setFormatter(_formatter)
-
-
-def get_logger(name: str) -> logging.Logger:
-    """Get a logger that writes to negotiation_chatbot.log."""
-    logger = logging.getLogger(name)
-    if not logger.handlers:
-        logger.setLevel(logging.DEBUG)
-        logger.addHandler(_file_handler)
-    return logger
+"""
+Logger configuration for Negotiation Chatbot.
+Writes logs to negotiation_chatbot.log in the project directory.
+
+Hot-path callers only enqueue records; a background QueueListener thread does
+the actual formatting and file I/O so request threads never block on disk.
+"""
+import atexit
+import logging
+import os
+import queue
+from logging.handlers import MemoryHandler, QueueHandler, QueueListener, RotatingFileHandler
+
+LOG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "negotiation_chatbot.txt")
+
+# Create formatter
+_formatter = logging.Formatter(
+    "%(asctime)s | %(levelname)-8s | %(name)s | %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+# Rotating file handler (runs on the listener thread): caps the log at
+# 10 MB x 5 backups so it never grows without bound
+_file_handler = RotatingFileHandler(
+    LOG_FILE, maxBytes=10 * 1024 * 1024, backupCount=5, encoding="utf-8"
+)
+_file_handler.setLevel(logging.DEBUG)
+_file_handler.setFormatter(_formatter)
+
+# Opt-in write batching: BUFFERED_FILE_LOGS=1 wraps the file handler in a
+# MemoryHandler so the listener flushes records to disk in batches of 64
+# (or immediately on ERROR) instead of one write syscall per record.
+_sink: logging.Handler = _file_handler
+if os.getenv("BUFFERED_FILE_LOGS") == "1":
+    _sink = MemoryHandler(capacity=64, flushLevel=logging.ERROR, target=_file_handler)
+    atexit.register(_sink.flush)
+
+# Queue feeding the background writer thread
+_log_queue: queue.Queue = queue.Queue(-1)
+_queue_handler = QueueHandler(_log_queue)
+_listener = QueueListener(_log_queue, _sink, respect_handler_level=True)
+_listener.start()
+atexit.register(_listener.stop)
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Get a logger that writes to negotiation_chatbot.log."""
+    logger = logging.getLogger(name)
+    if not logger.handlers:
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(_queue_handler)
+    return logger